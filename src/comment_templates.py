@@ -0,0 +1,212 @@
+import re
+import time
+import discord_logging
+from jinja2 import DictLoader, TemplateError
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+from prawcore.exceptions import NotFound, Forbidden
+
+log = discord_logging.get_logger()
+
+TEMPLATE_NAMES = ['comment', 'comment_footer', 'not_found']
+# a subreddit can override any of these by putting a line with just the name in brackets, like [comment_footer],
+# on its wiki page, followed by the template. Anything not overridden uses the default from the environment
+SECTION_PATTERN = re.compile(r'^\[(comment|comment_footer|not_found)\][ \t]*\r?$', re.MULTILINE)
+# how long we trust a subreddit's templates before checking if its wiki page has a new revision. Most subreddits never
+# make the page, so if it's missing we wait a lot longer before looking again
+CHECK_INTERVAL_SECONDS = 900
+NO_PAGE_CHECK_INTERVAL_SECONDS = 21600
+# the most wiki pages to fetch after each cycle's replies
+CHECKS_PER_CYCLE = 5
+
+# the fields shown in the comment. If none of these were found, there's nothing to reply with
+COMMENT_FIELDS = ['creator', 'member', 'author', 'material', 'pixev_src', 'gelbooru', 'danbooru', 'sankaku', 'deviantart_src']
+
+# whitespace matters for the reddit markdown, so this is all one line in the template. The {{on Pixiv}} style labels
+# are part of the comment text, not template expressions, so they're wrapped in raw blocks
+DEFAULT_COMMENT = (
+	"{% if saucenao.creator is not none or saucenao.member is not none or saucenao.author is not none %}"
+	"**Creator:** "
+	"{% if saucenao.creator is not none %}{{ saucenao.creator.title() }} | {% endif %}"
+	"{% if saucenao.member is not none %}{{ saucenao.member }}"
+	"{% if saucenao.pixev_art is not none %} [^({% raw %}{{on Pixiv}}{% endraw %})]({{ saucenao.pixev_art }}){% endif %}"
+	" | {% endif %}"
+	"{% if saucenao.author is not none and saucenao.member is none %}{{ saucenao.author }}"
+	"{% if saucenao.deviantart_art is not none %} [^({% raw %}{{on DeviantArt}}{% endraw %})]({{ saucenao.deviantart_art }}){% endif %}"
+	" | {% endif %}"
+	"\n\n{% endif %}"
+	"{% if saucenao.material is not none %}**Material:** {{ saucenao.material }}"
+	"{% if saucenao.material != 'original' %}"
+	" [^({% raw %}{{Google it!}}{% endraw %})](http://www.google.com/search?q={{ saucenao.material.replace(' ', '+') }})"
+	" [^({% raw %}{{Hentify it!}}{% endraw %})](https://gelbooru.com/index.php?page=post&s=list&tags={{ saucenao.material.replace(' ', '_') }})"
+	"{% endif %}"
+	"\n\n{% endif %}"
+	"{% if saucenao.pixev_src is not none or saucenao.gelbooru is not none or saucenao.danbooru is not none or saucenao.sankaku is not none or saucenao.deviantart_src is not none %}"
+	"**Image links:** "
+	"{% if saucenao.pixev_src is not none %}[Pixiv]({{ saucenao.pixev_src }}) | {% endif %}"
+	"{% if saucenao.gelbooru is not none %}[Gelbooru]({{ saucenao.gelbooru }}) | {% endif %}"
+	"{% if saucenao.danbooru is not none %}[Danbooru]({{ saucenao.danbooru }}) | {% endif %}"
+	"{% if saucenao.sankaku is not none %}[Sankaku]({{ saucenao.sankaku }}) | {% endif %}"
+	"{% if saucenao.deviantart_src is not none %}[DeviantArt]({{ saucenao.deviantart_src }}) | {% endif %}"
+	"\n\n{% endif %}"
+	"{% include 'comment_footer' %}"
+)
+
+
+def template_context(saucenao, submission):
+	"""Copies out the fields the templates can use. Any moderator can write a template on their wiki, so they only
+	ever get plain values, never the saucenao client or the praw objects.
+
+	:param saucenao: The SauceNAO result, or None for templates that don't show one
+	:param submission: The praw submission being replied to
+	:return: The dict to render templates with
+	"""
+	context = {
+		'submission': {
+			'id': submission.id,
+			'title': submission.title,
+			'url': submission.url,
+			'permalink': submission.permalink,
+			'author': {'name': submission.author.name} if submission.author is not None else None,
+			'subreddit': {'display_name': submission.subreddit.display_name},
+		},
+	}
+	if saucenao is not None:
+		fields = {key: getattr(saucenao, key) for key in saucenao.data_keys}
+		fields['image_url'] = saucenao.image_url
+		fields['public_link'] = saucenao.public_link
+		context['saucenao'] = fields
+	return context
+
+
+def parse_wiki_page(content):
+	sources = {}
+	# splitting on the section lines gives the text before the first section, then each section name and its text
+	parts = SECTION_PATTERN.split(content)
+	for i in range(1, len(parts) - 1, 2):
+		sources[parts[i]] = parts[i + 1].strip('\r\n')
+	return sources
+
+
+class TemplateSet:
+	# all the templates for one subreddit, compiled once up front. The comment template pulls in the footer with an
+	# include, so a reply is a single render. Templates can come from any subreddit's wiki, so they're sandboxed
+	def __init__(self, default_sources, overrides=None, revision=None):
+		self.revision = revision
+		self.overrides = overrides or {}
+		sources = dict(default_sources)
+		sources.update(self.overrides)
+		self.environment = ImmutableSandboxedEnvironment(loader=DictLoader(sources))
+		self.templates = {name: self.environment.get_template(name) for name in TEMPLATE_NAMES}
+
+	def render(self, template_name, context):
+		return self.templates[template_name].render(context)
+
+
+class SubredditTemplates:
+	def __init__(self, default_sources, page_name):
+		self.default_sources = default_sources
+		self.defaults = TemplateSet(default_sources)
+		self.page_name = page_name
+		# subreddit name -> (template set, when to check the wiki revision again)
+		self.subreddits = {}
+		# subreddit name -> snapshot entry, compiled the first time the subreddit needs them
+		self.restored = {}
+		# subreddit name -> praw subreddit, for subreddits whose wiki page needs checking by check_revisions
+		self.due = {}
+
+	def for_subreddit(self, subreddit):
+		"""Gets the compiled templates for a subreddit. This never fetches the wiki, if the subreddit is new or its
+		revision is due to be checked, it gets queued up for check_revisions and the current templates are used.
+
+		:param subreddit: The praw subreddit object
+		:return: The TemplateSet to render with
+		"""
+		name = subreddit.display_name.lower()
+		cached = self.subreddits.get(name)
+		if cached is None and name in self.restored:
+			cached = self.compile_restored(name)
+			self.subreddits[name] = cached
+		if cached is None or cached[1] <= time.time():
+			self.due.setdefault(name, subreddit)
+		return cached[0] if cached is not None else self.defaults
+
+	def render(self, subreddit, template_name, context):
+		"""Renders one of the subreddit's templates. If the subreddit's own template breaks while rendering, this falls
+		back to the default one, so a bad wiki edit can't stop the bot from processing the post.
+
+		:param subreddit: The praw subreddit object
+		:param template_name: comment or not_found
+		:param context: The dict from template_context
+		:return: The rendered text
+		"""
+		template_set = self.for_subreddit(subreddit)
+		try:
+			return template_set.render(template_name, context)
+		except Exception as err:
+			if len(template_set.overrides) == 0:
+				raise
+			log.warning(
+				f"Couldn't render {template_name} from revision {template_set.revision} of the wiki for "
+				f"r/{subreddit.display_name}, using the default: {err}")
+			return self.defaults.render(template_name, context)
+
+	def check_revisions(self, limit=CHECKS_PER_CYCLE):
+		"""Checks the wiki page of up to limit subreddits that are due, recompiling their templates if the revision
+		changed. Meant to be called after the submissions for a cycle have been replied to.
+
+		:param limit: The most wiki pages to fetch
+		:return: The number of wiki pages checked
+		"""
+		count_checked = 0
+		while len(self.due) > 0 and count_checked < limit:
+			name = next(iter(self.due))
+			subreddit = self.due.pop(name)
+			cached = self.subreddits.get(name)
+			self.subreddits[name] = self.load(subreddit, cached[0] if cached is not None else None)
+			count_checked += 1
+		return count_checked
+
+	def load(self, subreddit, current):
+		now = time.time()
+		try:
+			page = subreddit.wiki[self.page_name]
+			revision = page.revision_id
+		except (NotFound, Forbidden):
+			return self.defaults, now + NO_PAGE_CHECK_INTERVAL_SECONDS
+		except Exception as err:
+			log.warning(f"Couldn't check the template wiki page for r/{subreddit.display_name}: {err}")
+			return (current if current is not None else self.defaults), now + CHECK_INTERVAL_SECONDS
+
+		if current is not None and current.revision == revision:
+			return current, now + CHECK_INTERVAL_SECONDS
+
+		try:
+			template_set = TemplateSet(self.default_sources, parse_wiki_page(page.content_md), revision)
+			log.info(f"Loaded templates for r/{subreddit.display_name} from revision {revision}")
+		except TemplateError as err:
+			# remember the revision anyways, so we don't try compiling the same broken templates again
+			log.warning(f"Invalid templates on the wiki for r/{subreddit.display_name}, using the defaults: {err}")
+			template_set = TemplateSet(self.default_sources, revision=revision)
+		return template_set, now + CHECK_INTERVAL_SECONDS
+
+	def compile_restored(self, name):
+		entry = self.restored.pop(name)
+		if entry['revision'] is None:
+			template_set = self.defaults
+		else:
+			try:
+				template_set = TemplateSet(self.default_sources, entry['overrides'], entry['revision'])
+			except TemplateError:
+				template_set = TemplateSet(self.default_sources, revision=entry['revision'])
+		return template_set, entry['next_check']
+
+	def snapshot(self):
+		# keep the wiki sources rather than the compiled templates, along with the revision and when it's due to be
+		# checked, so a restart doesn't have to fetch every subreddit's wiki page again
+		subreddits = dict(self.restored)
+		for name, (template_set, next_check) in self.subreddits.items():
+			subreddits[name] = {'revision': template_set.revision, 'overrides': template_set.overrides, 'next_check': next_check}
+		return subreddits
+
+	def restore(self, subreddits):
+		self.restored.update(subreddits)
@@ -0,0 +1,68 @@
+import traceback
+import discord_logging
+
+log = discord_logging.get_logger()
+
+
+class InboxHandler:
+	def __init__(self, invites_per_cycle=5):
+		self.invites_per_cycle = invites_per_cycle
+		# message id -> message, for mod invites we haven't accepted yet. They're left unread until they're handled,
+		# so they get picked up again if the bot restarts in between
+		self.pending_invites = {}
+
+	def poll(self, reddit):
+		"""Sorts all the unread messages in one pass. Mod invites are queued up for process_invites, everything else
+		is marked read together at the end.
+
+		:param reddit: The praw reddit instance
+		:return: True if we were removed as a mod somewhere and the multireddits need to be rebuilt
+		"""
+		rebuild = False
+		count_other = 0
+		mark_read = []
+		for message in reddit.inbox.unread(limit=None):
+			if "invitation to moderate /r/" in message.subject:
+				if message.id not in self.pending_invites:
+					self.pending_invites[message.id] = message
+				continue
+
+			if "has been removed as a moderator from" in message.subject:
+				log.info(f"Removed as mod from r/{message.subreddit.display_name}")
+				rebuild = True
+			elif message.author is not None:
+				count_other += 1
+				log.debug(f"Got a message from u/{message.author.name}, but it's not a mod invite. {message.id}")
+			mark_read.append(message)
+
+		if count_other > 0:
+			log.info(f"Got {count_other} messages that aren't mod invites")
+		if len(mark_read) > 0:
+			# praw splits this up into as few requests as reddit allows
+			reddit.inbox.mark_read(mark_read)
+		return rebuild
+
+	def process_invites(self, reddit):
+		"""Accepts up to invites_per_cycle of the queued mod invites, then marks them read together.
+
+		:param reddit: The praw reddit instance
+		:return: True if an invite was accepted and the multireddits need to be rebuilt
+		"""
+		rebuild = False
+		handled = []
+		for message_id in list(self.pending_invites)[:self.invites_per_cycle]:
+			message = self.pending_invites.pop(message_id)
+			try:
+				log.info(f"Accepting mod invite for r/{message.subreddit.display_name}")
+				message.subreddit.mod.accept_invite()
+				rebuild = True
+			except Exception as err:
+				log.warning(f"Error accepting mod invite: {err}")
+				log.warning(traceback.format_exc())
+			handled.append(message)
+
+		if len(handled) > 0:
+			reddit.inbox.mark_read(handled)
+		if len(self.pending_invites) > 0:
+			log.info(f"{len(self.pending_invites)} mod invites left for the next cycle")
+		return rebuild
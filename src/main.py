@@ -8,9 +8,9 @@ import traceback
 import time
 import json
 import inspect
+from collections import deque
 from datetime import datetime
 from upstash_redis import Redis
-from jinja2 import Template
 from praw.exceptions import RedditAPIException
 from prawcore.exceptions import Forbidden
 
@@ -18,6 +18,10 @@ from prawcore.exceptions import Forbidden
 log = discord_logging.init_logging(folder=None)
 
 from saucenao import SauceNAO
+from sauce_cache import SauceCache
+from comment_templates import SubredditTemplates, DEFAULT_COMMENT, COMMENT_FIELDS, template_context
+from inbox import InboxHandler
+from snapshot import save_snapshot, load_snapshot, SNAPSHOT_INTERVAL_SECONDS
 
 
 def load_environment():
@@ -26,6 +30,10 @@ def load_environment():
 	variables_with_default = {
 		'caching': 'no',
 		'metrics': 'no',
+		'refreshes_per_minute': '10',
+		'templates_page': 'saucenaobot',
+		'invites_per_cycle': '5',
+		'snapshots': 'no',
 	}
 	variables = {}
 	for name in variable_names:
@@ -43,10 +51,12 @@ def load_environment():
 
 	
 def init_templates(env_values):
-	return {
-		'comment_footer': Template(env_values['comment_footer']),
-		'not_found': Template(env_values['not_found']),
-	}
+	# the environment templates are the defaults, subreddits can override them on their wiki
+	return SubredditTemplates({
+		'comment': DEFAULT_COMMENT,
+		'comment_footer': env_values['comment_footer'],
+		'not_found': env_values['not_found'],
+	}, env_values['templates_page'])
 
 
 def init_praw(env_variables):
@@ -92,16 +102,16 @@ def build_multireddits():
 	return multireddits
 
 
-def get_submissions_from_multireddit(reddit, multireddit, submissions):
+def get_submissions_from_multireddit(reddit, multireddit, submissions, processed_ids):
 	count_skipped = 0
 	try:
 		# we want to get a whole bunch of old submissions in case the bot hasn't been running for a while, but
 		# we also don't want to waste time getting all of them if we've already processed them. So when we process
 		# a submission, we'll save it. Then next time we check if it's saved, and skip it if it is. When we're
 		# loading submissions, if we get 10 that are saved, we can assume we've already processed all the older
-		# ones and stop looking
+		# ones and stop looking. We also remember the ids we processed recently, in case saving one didn't stick
 		for submission in reddit.subreddit(multireddit).new(limit=100):
-			if submission.saved:
+			if submission.saved or submission.id in processed_ids:
 				count_skipped += 1
 			else:
 				submissions.append(submission)
@@ -112,6 +122,16 @@ def get_submissions_from_multireddit(reddit, multireddit, submissions):
 		log.warning(traceback.format_exc())
 
 
+def snapshot_state(multireddits, processed_ids, cache, templates):
+	# everything we'd otherwise have to load from reddit on start up, plus the in memory caches
+	return {
+		'multireddits': multireddits,
+		'processed_ids': list(processed_ids),
+		'cache': cache.snapshot() if cache is not None else None,
+		'templates': templates.snapshot(),
+	}
+
+
 def record_metrics(redis, timestamp, bot, data):
 	# Add timestamp and bot to datapoint
 	data['ts'] = timestamp.timestamp()
@@ -121,17 +141,19 @@ def record_metrics(redis, timestamp, bot, data):
 	bucket = f"metrics_{int(hour.timestamp())}"
 	redis.lpush(bucket, json.dumps(data))
 
-def get_sauce(image_url, saucenao_key, redis=None, caching=False, metrics=False, submission=None):
+def get_sauce(image_url, saucenao_key, redis=None, cache=None, metrics=False, submission=None):
 	timestamp = datetime.now()
 	saucenao = SauceNAO(image_url, saucenao_key)
-	if caching:
-		# look up image url in cache
-		encoded = redis.get(image_url)
-		if encoded is not None:
-			log.info(f"Found cache entry for {image_url}")
-			saucenao.decode_string(encoded)
+	if cache is not None:
+		# look up image url in cache. Stale entries are still served right away, the cache queues them up to be
+		# refreshed on the cache's refresh thread
+		cached = cache.get(image_url)
+		if cached is not None:
+			entry, stale = cached
+			log.info(f"Found {'stale ' if stale else ''}cache entry for {image_url}")
+			saucenao.decode_string(entry['v'])
 			if metrics:
-				metadata = { 'cache': True, 'image': image_url, 'subreddit': submission.subreddit.display_name }
+				metadata = { 'cache': True, 'stale': stale, 'image': image_url, 'subreddit': submission.subreddit.display_name }
 				if saucenao.error_type is not None:
 					metadata['error_type'] = saucenao.error_type
 				record_metrics(redis, timestamp, saucenao_key, metadata)
@@ -139,6 +161,8 @@ def get_sauce(image_url, saucenao_key, redis=None, caching=False, metrics=False,
 
 	# query saucenao
 	metadata = saucenao.query()
+	if cache is not None:
+		cache.record_query(metadata)
 	if metrics:
 		metadata['cache'] = False
 		metadata['image'] = image_url
@@ -149,85 +173,24 @@ def get_sauce(image_url, saucenao_key, redis=None, caching=False, metrics=False,
 		print(f'Error: {metadata["error_type"]}')
 		return saucenao
 
-	if caching:
-		# store result in cache
-		expiration = 10800 if 'error_type' in metadata else 604800 # expire in a week
-		redis.set(image_url, saucenao.encode_string(), ex=expiration)
+	if cache is not None:
+		# store result in cache, not found results get a shorter expiry that grows each time we see them again
+		cache.store(saucenao)
 
 	return saucenao
 
 
 def build_comment(saucenao, templates, submission):
-	# take the saucenao fields and build out the comment to respond with
-	# rather than just appending strings one after another, we make a list of all of them and put them
-	# together at the end, it's more efficient
+	# take the saucenao fields and render the subreddit's comment template with them. The template is compiled ahead
+	# of time and includes the footer, so this is a single render
 	if saucenao.is_empty():
 		return None
 
-	bldr = []
-	if saucenao.creator is not None or saucenao.member is not None or saucenao.author is not None:
-		bldr.append('**Creator:** ')
-		if saucenao.creator is not None:
-			bldr.append(saucenao.creator.title())
-			bldr.append(' | ')
-		if saucenao.member is not None:
-			bldr.append(saucenao.member)
-			if saucenao.pixev_art is not None:
-				bldr.append(' [^({{on Pixiv}})](')
-				bldr.append(saucenao.pixev_art)
-				bldr.append(')')
-			bldr.append(' | ')
-		if saucenao.author is not None and saucenao.member is None:
-			bldr.append(saucenao.author)
-			if saucenao.deviantart_art is not None:
-				bldr.append(' [^({{on DeviantArt}})](')
-				bldr.append(saucenao.deviantart_art)
-				bldr.append(')')
-			bldr.append(' | ')
-		bldr.append('\n\n')
-
-	if saucenao.material is not None:
-		bldr.append('**Material:** ')
-		bldr.append(saucenao.material)
-		if saucenao.material != 'original':
-			bldr.append(' [^({{Google it!}})](http://www.google.com/search?q=')
-			bldr.append(saucenao.material.replace(' ', '+'))
-			bldr.append(') [^({{Hentify it!}})](https://gelbooru.com/index.php?page=post&s=list&tags=')
-			bldr.append(saucenao.material.replace(' ', '_'))
-			bldr.append(')')
-		bldr.append('\n\n')
-
-	if saucenao.pixev_src is not None or saucenao.gelbooru is not None or saucenao.danbooru is not None or saucenao.sankaku is not None or saucenao.deviantart_src is not None:
-		bldr.append('**Image links:** ')
-		if saucenao.pixev_src is not None:
-			bldr.append('[Pixiv](')
-			bldr.append(saucenao.pixev_src)
-			bldr.append(') | ')
-		if saucenao.gelbooru is not None:
-			bldr.append('[Gelbooru](')
-			bldr.append(saucenao.gelbooru)
-			bldr.append(') | ')
-		if saucenao.danbooru is not None:
-			bldr.append('[Danbooru](')
-			bldr.append(saucenao.danbooru)
-			bldr.append(') | ')
-		if saucenao.sankaku is not None:
-			bldr.append('[Sankaku](')
-			bldr.append(saucenao.sankaku)
-			bldr.append(') | ')
-		if saucenao.deviantart_src is not None:
-			bldr.append('[DeviantArt](')
-			bldr.append(saucenao.deviantart_src)
-			bldr.append(') | ')
-		bldr.append('\n\n')
-
 	# Handle no results
-	if len(bldr) == 0:
+	if all(getattr(saucenao, field) is None for field in COMMENT_FIELDS):
 		return None
 
-	bldr.append(templates['comment_footer'].render({ 'saucenao': saucenao, 'submission': submission }))
-
-	return ''.join(bldr)
+	return templates.render(submission.subreddit, 'comment', template_context(saucenao, submission))
 
 
 def try_reply(submission, comment_body):
@@ -260,17 +223,42 @@ if __name__ == '__main__':
 
 	templates = init_templates(env_values)
 
-	reddit = init_praw(env_values)
-	if reddit is None:
-		sys.exit(1)
-
 	caching = env_values['caching'] == 'yes'
 	metrics = env_values['metrics'] == 'yes'
+	snapshots = env_values['snapshots'] == 'yes'
 	# redis = Redis.from_url(env_values['REDIS_URL']) if caching or metrics else None
-	redis = Redis.from_env() if caching or metrics else None
+	redis = Redis.from_env() if caching or metrics or snapshots else None
+	cache = SauceCache(redis, int(env_values['refreshes_per_minute'])) if caching else None
+	inbox = InboxHandler(int(env_values['invites_per_cycle']))
+	# ids of the submissions we've processed recently, on top of the saved flag on reddit
+	processed_ids = deque(maxlen=1000)
 
-	log.info("Loading list of moderated subs...")
-	multireddits = build_multireddits()
+	snapshot = load_snapshot(redis) if snapshots else None
+
+	# even on a warm start we check the login, it's a single request and bad credentials should stop the bot here
+	# rather than fail every cycle
+	reddit = init_praw(env_values)
+	if reddit is None:
+		sys.exit(1)
+
+	if snapshot is not None:
+		# start polling with the subs we had last time, and check them against reddit once the first cycle is done
+		multireddits = snapshot['multireddits']
+		processed_ids.extend(snapshot['processed_ids'])
+		if cache is not None and snapshot['cache'] is not None:
+			cache.restore(snapshot['cache'])
+		templates.restore(snapshot['templates'])
+		log.info(f"Restored {len(multireddits)} multireddits from snapshot")
+		reconcile = True
+	else:
+		log.info("Loading list of moderated subs...")
+		multireddits = build_multireddits()
+		reconcile = False
+	last_snapshot = time.time()
+
+	if cache is not None:
+		# stale cache entries are refreshed on their own thread with whatever saucenao quota is left over
+		cache.start_refreshing(env_values['saucenao_key'])
 
 	log.info(f"Finished start up, checking submissions and messages")
 	# just keep looping forever
@@ -278,7 +266,7 @@ if __name__ == '__main__':
 		try:
 			submissions = []
 			for multireddit in multireddits:
-				get_submissions_from_multireddit(reddit, multireddit, submissions)
+				get_submissions_from_multireddit(reddit, multireddit, submissions, processed_ids)
 
 			if len(submissions) > 0:
 				log.debug(f"Processing {len(submissions)} submissions")
@@ -297,25 +285,27 @@ if __name__ == '__main__':
 					if image_url is None:
 						log.info(
 							f"Post {submission.id} in r/{submission.subreddit.display_name} didn't have a url to lookup")
-						result_comment = try_reply(submission, templates['not_found'].render({ 'submission': submission }))
+						result_comment = try_reply(submission, templates.render(submission.subreddit, 'not_found', template_context(None, submission)))
 						if result_comment is not None:
 							try_mod_action(submission.subreddit, lambda: result_comment.mod.remove())
 					else:
 						log.info(
 							f"Processing post {submission.id} in r/{submission.subreddit.display_name} with url {image_url}")
 						# get saucenao results (with Redis caching)
-						saucenao = get_sauce(image_url, env_values['saucenao_key'], redis, caching, metrics, submission)
+						saucenao = get_sauce(image_url, env_values['saucenao_key'], redis, cache, metrics, submission)
 						# try building the result comment
 						comment_reply = build_comment(saucenao, templates, submission)
 
 						# if we didn't find a source, message the post author and post the comment
 						if comment_reply is None:
+							# render the reply before messaging the author, so a template error can't message them twice
+							not_found_reply = templates.render(submission.subreddit, 'not_found', template_context(None, submission))
 							log.info(f"Couldn't find a source, messaging author u/{submission.author.name}")
 							submission.author.message(
 								"Sauce not found!",
 								f"I couldn't find the source for your [recent submission]({submission.permalink}). "
 								f"Please consider putting it in the comments yourself.")
-							result_comment = try_reply(submission, templates['not_found'].render({ 'submission': submission }))
+							result_comment = try_reply(submission, not_found_reply)
 							if result_comment is not None:
 								try_mod_action(submission.subreddit, lambda: result_comment.mod.remove())
 						else:
@@ -325,28 +315,27 @@ if __name__ == '__main__':
 								try_mod_action(submission.subreddit, lambda: result_comment.mod.distinguish(sticky=True))
 
 					submission.save()
-
-			# check messages for mod invites
-			for message in reddit.inbox.unread():
-				rebuild = False
-				if "invitation to moderate /r/" in message.subject:
-					try:
-						log.info(f"Accepting mod invite for r/{message.subreddit.display_name}")
-						message.subreddit.mod.accept_invite()
-						rebuild = True
-					except Exception as err:
-						log.warning(f"Error accepting mod invite: {err}")
-						log.warning(traceback.format_exc())
-
-				if "has been removed as a moderator from" in message.subject:
-					log.info(f"Removed as mod from r/{message.subreddit.display_name}")
-					rebuild = True
-
-				if rebuild:
-					multireddits = build_multireddits()
-				elif message.author is not None:
-					log.info(f"Got a message from u/{message.author.name}, but it's not a mod invite. {message.id}")
-				message.mark_read()
+					processed_ids.append(submission.id)
+
+			# check messages for mod invites. Everything else is marked read in bulk, and the invites are accepted a
+			# few at a time so a pile of messages doesn't hold up the next round of submissions
+			rebuild = inbox.poll(reddit)
+			if inbox.process_invites(reddit):
+				rebuild = True
+			if rebuild or reconcile:
+				if reconcile:
+					log.info("Reconciling moderated subs from snapshot with reddit")
+				multireddits = build_multireddits()
+				reconcile = False
+				# snapshot the new list of subs right away rather than waiting for the interval
+				last_snapshot = 0
+
+			# check the template wiki pages of the subreddits we replied in, outside of the replies themselves
+			templates.check_revisions()
+
+			if snapshots and time.time() - last_snapshot >= SNAPSHOT_INTERVAL_SECONDS:
+				save_snapshot(redis, snapshot_state(multireddits, processed_ids, cache, templates))
+				last_snapshot = time.time()
 
 			time.sleep(15)
 
@@ -0,0 +1,184 @@
+import json
+import time
+import threading
+import traceback
+import discord_logging
+
+from saucenao import SauceNAO
+
+log = discord_logging.get_logger()
+
+# results are fresh for a week, then served stale for up to three more weeks while they get refreshed in the background
+FOUND_FRESH_SECONDS = 604800
+FOUND_EXPIRE_SECONDS = 604800 * 4
+# the first not found is only trusted for 3 hours, but each time saucenao says it still doesn't know the image we
+# double that, up to 4 weeks. Not found entries are kept around for twice their fresh time so they can be served stale
+NOT_FOUND_FRESH_SECONDS = 10800
+NOT_FOUND_MAX_FRESH_SECONDS = 604800 * 4
+# how many times in a row an image wasn't found is kept under its own key for longer than the entry itself, so the
+# count keeps growing even when the image only comes back after its entry expired
+NOT_FOUND_SEEN_SECONDS = 604800 * 8
+# how long the refresh thread waits before checking the quota again when it's running low
+QUOTA_WAIT_SECONDS = 30
+# don't let the refresh queue grow forever if we're out of quota for a long time, stale entries are still served
+MAX_PENDING_REFRESHES = 500
+
+
+def seen_key(image_url):
+	return f"seen_{image_url}"
+
+
+def parse_entry(raw):
+	try:
+		value = json.loads(raw)
+	except ValueError:
+		value = None
+	if isinstance(value, dict):
+		return value
+	# entries written before we tracked expiries are just the encoded result. Treat them as fresh until redis expires them
+	return {'v': raw, 'soft': None, 'seen': 0}
+
+
+class QuotaBudget:
+	# saucenao tells us how many searches are left in the short (30 second) and long (24 hour) windows with every
+	# result. Background refreshes only spend searches while there's enough left over for new submissions
+	def __init__(self, short_reserve=2, long_reserve_ratio=0.25):
+		self.short_reserve = short_reserve
+		self.long_reserve_ratio = long_reserve_ratio
+		self.short_remaining = None
+		self.long_remaining = None
+		self.long_limit = None
+		self.paused_until = 0
+
+	def update(self, metadata):
+		error_type = metadata.get('error_type')
+		if error_type == 'DailyLimitReachedException':
+			self.paused_until = time.time() + 3600
+		elif error_type is not None and error_type != 'not_found':
+			# includes hitting the short limit, wait for the 30 second window to roll over before spending more
+			self.paused_until = time.time() + 60
+
+		if metadata.get('long_remaining') is not None:
+			self.short_remaining = int(metadata['short_remaining'])
+			self.long_remaining = int(metadata['long_remaining'])
+			self.long_limit = int(metadata['long_limit'])
+
+	def allows_refresh(self):
+		if time.time() < self.paused_until:
+			return False
+		if self.long_remaining is None:
+			# we haven't seen any limits yet, the first refresh will tell us where we stand
+			return True
+		return self.short_remaining > self.short_reserve and \
+			self.long_remaining > self.long_limit * self.long_reserve_ratio
+
+
+class SauceCache:
+	def __init__(self, redis, refreshes_per_minute=10):
+		self.redis = redis
+		self.refresh_interval = 60 / refreshes_per_minute
+		self.quota = QuotaBudget()
+		# image url -> cache entry, for stale entries waiting on the refresh thread. Shared with that thread, so it's
+		# only touched while holding the condition
+		self.pending = {}
+		self.condition = threading.Condition()
+
+	def get(self, image_url):
+		"""Looks up an image in the cache. Stale entries are still returned, but queued up to be refreshed.
+
+		:param image_url: The image url the result was stored under
+		:return: A tuple of the cache entry and whether it's stale, or None if there's nothing cached
+		"""
+		raw = self.redis.get(image_url)
+		if raw is None:
+			return None
+
+		entry = parse_entry(raw)
+		stale = entry['soft'] is not None and entry['soft'] < time.time()
+		if stale:
+			self.queue_refresh(image_url, entry)
+		return entry, stale
+
+	def queue_refresh(self, image_url, entry):
+		with self.condition:
+			if image_url not in self.pending and len(self.pending) < MAX_PENDING_REFRESHES:
+				self.pending[image_url] = entry
+				self.condition.notify()
+
+	def store(self, saucenao, previous=None):
+		"""Stores a query result with a soft expiry, after which it's refreshed, and a hard expiry, after which redis
+		drops it.
+
+		:param saucenao: The SauceNAO object that was queried
+		:param previous: The cache entry this result replaces, if there was one
+		"""
+		if saucenao.error_type == 'not_found':
+			if previous is not None:
+				seen_before = previous['seen']
+			else:
+				seen_before = int(self.redis.get(seen_key(saucenao.image_url)) or 0)
+			seen = seen_before + 1
+			fresh = min(NOT_FOUND_FRESH_SECONDS * 2 ** min(seen - 1, 16), NOT_FOUND_MAX_FRESH_SECONDS)
+			expire = fresh * 2
+			self.redis.set(seen_key(saucenao.image_url), seen, ex=NOT_FOUND_SEEN_SECONDS)
+		else:
+			seen = 0
+			fresh = FOUND_FRESH_SECONDS
+			expire = FOUND_EXPIRE_SECONDS
+			if previous is not None and previous['seen'] > 0:
+				# it was found after all, start counting from scratch if it ever goes missing again
+				self.redis.delete(seen_key(saucenao.image_url))
+
+		entry = {'v': saucenao.encode_string(), 'soft': time.time() + fresh, 'seen': seen}
+		self.redis.set(saucenao.image_url, json.dumps(entry), ex=expire)
+
+	def snapshot(self):
+		# the refresh queue only lives in memory, so save it to keep refreshing the same entries after a restart
+		with self.condition:
+			return {'pending': dict(self.pending)}
+
+	def restore(self, state):
+		for image_url, entry in state['pending'].items():
+			self.queue_refresh(image_url, entry)
+
+	def record_query(self, metadata):
+		self.quota.update(metadata)
+
+	def start_refreshing(self, saucenao_key):
+		"""Starts the thread that re-queries saucenao for stale entries, so the searches never hold up polling.
+
+		:param saucenao_key: The saucenao api key to query with
+		"""
+		thread = threading.Thread(target=self.refresh_loop, args=(saucenao_key,), name="cache_refresh", daemon=True)
+		thread.start()
+
+	def next_refresh(self):
+		with self.condition:
+			while len(self.pending) == 0:
+				self.condition.wait()
+			image_url = next(iter(self.pending))
+			return image_url, self.pending.pop(image_url)
+
+	def refresh_loop(self, saucenao_key):
+		while True:
+			try:
+				if not self.quota.allows_refresh():
+					time.sleep(QUOTA_WAIT_SECONDS)
+					continue
+
+				image_url, previous = self.next_refresh()
+				saucenao = SauceNAO(image_url, saucenao_key)
+				metadata = saucenao.query()
+				self.record_query(metadata)
+
+				if 'error_type' in metadata and metadata['error_type'] != 'not_found':
+					# leave the stale entry alone, it'll keep being served until the hard expiry
+					log.info(f"Couldn't refresh cache entry for {image_url}: {metadata['error_type']}")
+				else:
+					self.store(saucenao, previous)
+					log.debug(f"Refreshed cache entry for {image_url}")
+			except Exception as err:
+				log.warning(f"Error refreshing cache entry: {err}")
+				log.warning(traceback.format_exc())
+			# spread the refreshes out, so they don't eat the short limit the submissions need
+			time.sleep(self.refresh_interval)
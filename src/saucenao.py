@@ -1,6 +1,7 @@
 import zlib
 import json
 import asyncio
+import threading
 from pysaucenao import SauceNao as Client, PixivSource, SauceNaoException
 
 METADATA_NAMES = ['short_limit', 'long_limit', 'long_remaining', 'short_remaining']
@@ -8,10 +9,12 @@ METADATA_NAMES = ['short_limit', 'long_limit', 'long_remaining', 'short_remainin
 clients = {}
 
 def get_client(api_key):
-	client = clients.get(api_key)
+	# each thread gets its own client, since every query runs in that thread's own event loop
+	key = (api_key, threading.get_ident())
+	client = clients.get(key)
 	if client is None:
 		client = Client(api_key=api_key)
-		clients[api_key] = client
+		clients[key] = client
 	return client
 
 # def call_async(coro):
@@ -85,9 +88,14 @@ class SauceNAO:
 			self.error_type = type(err).__name__.split('.').pop()
 			return { 'error_type': self.error_type }
 
+		metadata = {}
+		for meta in METADATA_NAMES:
+			metadata[meta] = getattr(results, meta)
+
 		if len(results) < 1:
 			self.error_type = 'not_found'
-			return { 'error_type': self.error_type }
+			metadata['error_type'] = self.error_type
+			return metadata
 
 		for result in results:
 			if hasattr(result, 'material') and isinstance(result.material, list):
@@ -113,9 +121,6 @@ class SauceNAO:
 					elif 'chan.sankakucomplex.com' in url:
 						self.update_if_none('sankaku', url)
 
-		metadata = {}
-		for meta in METADATA_NAMES:
-			metadata[meta] = getattr(results, meta)
 		return metadata
 
 
@@ -0,0 +1,62 @@
+import json
+import time
+import traceback
+import discord_logging
+
+log = discord_logging.get_logger()
+
+SNAPSHOT_KEY = 'state_snapshot'
+# bump this if the layout of the snapshot changes, older snapshots are then ignored and we do a cold start
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL_SECONDS = 300
+# a snapshot older than this is more likely to be wrong than helpful
+SNAPSHOT_EXPIRE_SECONDS = 172800
+
+
+def save_snapshot(redis, state):
+	"""Saves the bot's working state to redis so the next start up can skip loading it from reddit.
+
+	:param redis: The redis client
+	:param state: A dict of json serializable state
+	:return: True if the snapshot was saved
+	"""
+	snapshot = dict(state)
+	snapshot['version'] = SNAPSHOT_VERSION
+	snapshot['ts'] = time.time()
+	try:
+		redis.set(SNAPSHOT_KEY, json.dumps(snapshot), ex=SNAPSHOT_EXPIRE_SECONDS)
+		log.debug("Saved state snapshot")
+		return True
+	except Exception as err:
+		log.warning(f"Couldn't save state snapshot: {err}")
+		log.warning(traceback.format_exc())
+		return False
+
+
+def load_snapshot(redis):
+	"""Loads the last saved snapshot.
+
+	:param redis: The redis client
+	:return: The state dict, or None if there isn't a usable snapshot
+	"""
+	try:
+		encoded = redis.get(SNAPSHOT_KEY)
+	except Exception as err:
+		log.warning(f"Couldn't load state snapshot: {err}")
+		log.warning(traceback.format_exc())
+		return None
+	if encoded is None:
+		log.info("No state snapshot found")
+		return None
+
+	try:
+		snapshot = json.loads(encoded)
+	except ValueError:
+		log.warning("State snapshot is corrupt, ignoring it")
+		return None
+	if snapshot.get('version') != SNAPSHOT_VERSION:
+		log.info(f"State snapshot is version {snapshot.get('version')}, expected {SNAPSHOT_VERSION}, ignoring it")
+		return None
+
+	log.info(f"Loaded state snapshot from {int(time.time() - snapshot['ts'])} seconds ago")
+	return snapshot